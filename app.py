@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
+import asyncio
 import csv
 import io
+import itertools
 import os
 import re
-from typing import Dict, Set, List
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, FrozenSet, Set, List, Optional, Tuple
 
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
 
 # Required env vars:
 # SLACK_BOT_TOKEN = xoxb-...
@@ -16,7 +21,7 @@ from slack_sdk.errors import SlackApiError
 BOT_TOKEN = os.environ["SLACK_BOT_TOKEN"]
 APP_TOKEN = os.environ["SLACK_APP_TOKEN"]
 
-EXCLUDED_USER_IDS = {
+EXCLUDED_USER_IDS = frozenset({
     "U040FETSCDN",
     "U09NBRAU7MG",
     "U07M27PDWN7",
@@ -24,25 +29,27 @@ EXCLUDED_USER_IDS = {
     "U03V0E6RFGA",
     "U05NNHVHQUU",
     "U09BRJQRXNJ",
-}
+})
 
-app = App(token=BOT_TOKEN)
-client = WebClient(token=BOT_TOKEN)
+# One shared async client for the app and all helpers; back off and retry
+# on 429s instead of failing the whole command.
+client = AsyncWebClient(token=BOT_TOKEN, timeout=30)
+client.retry_handlers.append(AsyncRateLimitErrorRetryHandler(max_retry_count=3))
+app = AsyncApp(client=client)
 
 # ---------- Utilities ----------
 
+# Slack permalinks put seconds+micros with no dot. Matched with fullmatch
+# against a single token so arbitrary user text never gets scanned.
 MSG_URL_RE = re.compile(
-    r"https?://[^/]+/archives/(?P<channel>[A-Z0-9]+)/p(?P<pts>\d{16,})"
+    r"https?://[^\s/]+/archives/(?P<channel>[A-Z0-9]+)/p(?P<sec>\d{10,})(?P<us>\d{6})(?:\?\S*)?",
+    re.ASCII,
 )
 
-def ts_from_permalink_pts(pts: str) -> str:
-    # Slack permalinks put seconds+micros with no dot
-    return f"{pts[:-6]}.{pts[-6:]}"
-
-def paged(func, **kwargs):
+async def apaged(func, **kwargs):
     cursor = None
     while True:
-        resp = func(cursor=cursor, **kwargs)
+        resp = await func(cursor=cursor, **kwargs)
         yield resp
         cursor = resp.get("response_metadata", {}).get("next_cursor")
         if not cursor:
@@ -57,150 +64,301 @@ def keep_user(u: dict) -> bool:
         return False
     return True
 
-def user_dir_map() -> Dict[str, dict]:
+USER_DIR_TTL_SECONDS = 600
+
+def ttl_cache(ttl: float):
+    # Cache a zero-arg coroutine's result for `ttl` seconds (process-wide).
+    # The lock makes concurrent callers share one fetch instead of racing.
+    # `update(fn)` applies fn to the cached value in place; updates that
+    # arrive mid-fetch are queued and applied to the fresh value before it's
+    # stored, so they aren't lost.
+    def decorator(func):
+        lock = asyncio.Lock()
+        entry = {}
+        pending = []
+        fetching = False
+
+        @wraps(func)
+        async def wrapper():
+            nonlocal fetching
+            async with lock:
+                if entry and time.monotonic() - entry["at"] < ttl:
+                    return entry["value"]
+                fetching = True
+                try:
+                    value = await func()
+                except BaseException:
+                    pending.clear()
+                    raise
+                finally:
+                    fetching = False
+                for fn in pending:
+                    fn(value)
+                pending.clear()
+                entry.update(at=time.monotonic(), value=value)
+                return value
+
+        def update(fn):
+            if fetching:
+                pending.append(fn)
+            elif entry:
+                fn(entry["value"])
+
+        wrapper.update = update
+        return wrapper
+    return decorator
+
+@ttl_cache(USER_DIR_TTL_SECONDS)
+async def user_dir_map() -> Tuple[Dict[str, dict], Set[str]]:
+    # Returns the directory plus the ids passing keep_user, computed once per
+    # fetch so commands only need a set intersection.
     users = {}
     cursor = None
     while True:
-        resp = client.users_list(limit=200, cursor=cursor)
+        resp = await client.users_list(limit=1000, cursor=cursor)
         for u in resp.get("members", []):
             users[u["id"]] = u
         cursor = resp.get("response_metadata", {}).get("next_cursor")
         if not cursor:
             break
-    return users
+    valid_ids = {uid for uid, u in users.items() if keep_user(u)}
+    return users, valid_ids
 
-def format_name(u: dict) -> str:
-    profile = (u or {}).get("profile", {}) or {}
+def format_name_known(u: dict) -> str:
+    # For users straight from the directory: always a dict with id and profile
+    profile = u["profile"]
     display = profile.get("display_name_normalized") or profile.get("display_name")
     real = profile.get("real_name_normalized") or profile.get("real_name")
     if display and display != real:
         return f"{display} ({real})"
-    return display or real or (u or {}).get("name") or (u or {}).get("id", "unknown")
-
-def channel_members(channel: str, users: Dict[str, dict]) -> Set[str]:
-    ids = set()
-    for resp in paged(client.conversations_members, channel=channel, limit=1000):
-        for uid in resp.get("members", []):
-            if keep_user(users.get(uid)):
-                ids.add(uid)
-    return ids
+    return display or real or u.get("name") or u["id"]
 
-def fetch_message(channel: str, ts: str) -> dict:
-    resp = client.conversations_history(channel=channel, latest=ts, inclusive=True, limit=1)
-    msgs = resp.get("messages", [])
-    if not msgs or msgs[0].get("ts") != ts:
-        raise RuntimeError("Message not found at that timestamp.")
-    return msgs[0]
+CHANNEL_MEMBERS_TTL_SECONDS = 180
+CHANNEL_MEMBERS_MAX_ENTRIES = 64
 
-def reactors(channel: str, ts: str) -> Set[str]:
-    try:
-        r = client.reactions_get(channel=channel, timestamp=ts)
-        out = set()
-        for rxn in (r.get("message", {}) or {}).get("reactions", []) or []:
-            out.update(rxn.get("users", []) or [])
-        return out
-    except SlackApiError:
-        # fallback read from message body
-        msg = fetch_message(channel, ts)
-        out = set()
-        for rxn in msg.get("reactions", []) or []:
-            out.update(rxn.get("users", []) or [])
-        return out
-
-def repliers(channel: str, ts: str) -> Set[str]:
-    s = set()
-    for resp in paged(client.conversations_replies, channel=channel, ts=ts, limit=200):
+# channel id -> (fetched_at, frozenset of raw member ids), oldest first.
+# Only touched from the event loop with no await between read and write, so
+# it needs no lock.
+_channel_members_cache: "OrderedDict[str, Tuple[float, FrozenSet[str]]]" = OrderedDict()
+
+async def channel_member_ids(channel: str) -> FrozenSet[str]:
+    hit = _channel_members_cache.get(channel)
+    if hit and time.monotonic() - hit[0] < CHANNEL_MEMBERS_TTL_SECONDS:
+        _channel_members_cache.move_to_end(channel)
+        return hit[1]
+
+    member_ids = []
+    cursor = None
+    while True:
+        resp = await client.conversations_members(channel=channel, limit=1000, cursor=cursor)
+        member_ids.extend(resp.get("members", []))
+        cursor = resp.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+    ids = frozenset(member_ids)
+    _channel_members_cache[channel] = (time.monotonic(), ids)
+    _channel_members_cache.move_to_end(channel)
+    while len(_channel_members_cache) > CHANNEL_MEMBERS_MAX_ENTRIES:
+        _channel_members_cache.popitem(last=False)
+    return ids
+
+def update_cached_members(channel: str, add: Optional[str] = None, remove: Optional[str] = None):
+    hit = _channel_members_cache.get(channel)
+    if not hit:
+        # Nothing cached yet. An event landing while a fetch for this channel
+        # is in flight is dropped here; the 3-minute TTL bounds that staleness.
+        return
+    fetched_at, ids = hit
+    if add:
+        ids = ids | {add}
+    if remove:
+        ids = ids - {remove}
+    _channel_members_cache[channel] = (fetched_at, ids)
+
+async def engagers(
+    channel: str, ts: str, population: "Optional[asyncio.Future]" = None
+) -> Tuple[Set[str], Set[str], Optional[str]]:
+    # One pass over the thread: the parent message in conversations.replies
+    # carries its reactions, so reactions.get isn't needed.
+    # If `population` (a future resolving to the member-id set) is done and
+    # everyone in it has already engaged, later pages can't change the result.
+    reactor_set, replier_set = set(), set()
+    parent_user = None
+    found = False
+    async for resp in apaged(client.conversations_replies, channel=channel, ts=ts, limit=1000):
         for m in resp.get("messages", []):
+            if m.get("ts") == ts:
+                found = True
+                parent_user = m.get("user")
+                for rxn in m.get("reactions") or []:
+                    reactor_set.update(rxn.get("users") or [])
             if m.get("user") and not m.get("subtype"):
-                s.add(m["user"])
+                replier_set.add(m["user"])
+        if (
+            found
+            and population is not None
+            and population.done()
+            and not population.cancelled()
+            and population.exception() is None
+        ):
+            # excluded accounts never count, so don't wait on them
+            considered = population.result() - EXCLUDED_USER_IDS
+            if considered <= reactor_set | replier_set | {parent_user}:
+                break
+    if not found:
+        raise RuntimeError("Message not found at that timestamp.")
     # remove parent author
-    try:
-        parent = fetch_message(channel, ts).get("user")
-        if parent in s:
-            s.discard(parent)
-    except Exception:
-        pass
-    return s
-
-def make_csv(non_engagers: List[str], users: Dict[str, dict]) -> bytes:
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["user_id", "name"])
-    for uid in non_engagers:
-        w.writerow([uid, format_name(users.get(uid))])
-    return buf.getvalue().encode("utf-8")
+    replier_set.discard(parent_user)
+    return reactor_set, replier_set, parent_user
+
+# user id -> DM channel id; DM channel ids are stable, so never expire
+_dm_cache: Dict[str, str] = {}
+
+async def dm_for(user_id: str) -> str:
+    dm = _dm_cache.get(user_id)
+    if dm is None:
+        dm = (await client.conversations_open(users=[user_id]))["channel"]["id"]
+        _dm_cache[user_id] = dm
+    return dm
+
+def make_csv(non_engagers: List[str], name_by_id: Dict[str, str]) -> bytes:
+    # Encode straight into the bytes buffer instead of building a str and
+    # copying it via .encode()
+    buf = io.BytesIO()
+    tw = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    w = csv.writer(tw)
+    w.writerow(("user_id", "name"))
+    w.writerows((uid, name_by_id[uid]) for uid in non_engagers)
+    tw.flush()
+    data = buf.getvalue()
+    tw.detach()  # don't let the wrapper close buf when it's collected
+    return data
 
 def summarize(names: List[str], limit=20) -> str:
-    shown = names[:limit]
-    extra = len(names) - len(shown)
-    body = "\n".join([f"• {n}" for n in shown])
+    shown = itertools.islice(names, limit)
+    extra = max(0, len(names) - limit)
+    body = "\n".join(f"• {n}" for n in shown)
     if extra > 0:
         body += f"\n…and {extra} more"
     return body
 
-def compute_nonengagers(channel: str, ts: str):
-    users = user_dir_map()
-    pop = channel_members(channel, users)
-    msg = fetch_message(channel, ts)
-    author = msg.get("user")
+async def compute_nonengagers(channel: str, ts: str):
+    users_task = asyncio.ensure_future(user_dir_map())
+    # Never cancel this one: it may be the caller holding the directory cache
+    # lock mid-traversal, and other commands are waiting on its result. Just
+    # make sure a failure is always observed.
+    users_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def population():
+        # Raw membership doesn't depend on the directory, so both reads run
+        # concurrently; filtering is then a single set intersection.
+        raw_members = await channel_member_ids(channel)
+        _, valid_ids = await users_task
+        return raw_members & valid_ids
+
+    # The thread read runs alongside and can stop paging early once the
+    # population is known and fully engaged.
+    pop_task = asyncio.ensure_future(population())
+    engagers_task = asyncio.ensure_future(engagers(channel, ts, population=pop_task))
+    try:
+        pop, (reactor_set, replier_set, author) = await asyncio.gather(
+            pop_task, engagers_task
+        )
+    finally:
+        # On an error path one of these may still be running (or have failed
+        # unobserved); cancel or reap it so nothing is left dangling.
+        for task in (engagers_task, pop_task):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+    users, _ = users_task.result()
+    engaged = reactor_set | replier_set
 
-    engaged = set(reactors(channel, ts)) | set(repliers(channel, ts))
     if author:
         engaged.add(author)
 
-    engaged = {uid for uid in engaged if uid in pop}
-    pop = {uid for uid in pop if uid not in EXCLUDED_USER_IDS}
-    non = sorted(pop - engaged)
-    names = [format_name(users.get(uid)) for uid in non]
+    # count engagement against the same population we report, so excluded
+    # accounts can't inflate "Engaged" (and an early exit can't change it)
+    considered = pop - EXCLUDED_USER_IDS
+    engaged = {uid for uid in engaged if uid in considered}
+    non = sorted(uid for uid in considered if uid not in engaged)
+    # format each name once; the summary and the CSV both reuse these
+    # (pop is a subset of valid_ids, so every uid is in the directory)
+    name_by_id = {uid: format_name_known(users[uid]) for uid in non}
+    names = [name_by_id[uid] for uid in non]
     return {
-        "population_ids": pop,
+        "population_ids": considered,
         "engaged_ids": engaged,
         "non_ids": non,
         "non_names": names,
+        "name_by_id": name_by_id,
     }
 
+async def deliver(dm: str, text: str, result: dict, logger) -> List[str]:
+    # The summary post and the CSV upload are independent; send them together
+    # and let each fail on its own so one error doesn't drop the other.
+    # Returns what failed to send (already logged) so callers can say so.
+    labels = ["summary"]
+    calls = [client.chat_postMessage(channel=dm, text=text)]
+    if result["non_ids"]:
+        labels.append("CSV")
+        calls.append(client.files_upload_v2(
+            channel=dm,
+            filename="non_engagers.csv",
+            title="Non-engagers",
+            file=make_csv(result["non_ids"], result["name_by_id"]),
+        ))
+    failed = []
+    for label, r in zip(labels, await asyncio.gather(*calls, return_exceptions=True)):
+        if isinstance(r, Exception):
+            logger.error("Failed to send %s", label, exc_info=r)
+            failed.append(label)
+    return failed
+
+def delivery_failure_text(failed: List[str]) -> str:
+    return f"I computed the results but couldn’t DM you the {' or '.join(failed)}. Please try again."
+
 # ---------- Message Shortcut: "Find non-engagers" ----------
 # In Slack App config, create a Message Shortcut with callback_id = find_non_engagers
 @app.shortcut("find_non_engagers")
-def on_shortcut(ack, body, logger):
-    ack()  # acknowledge immediately (required)
+async def on_shortcut(ack, body, logger):
+    await ack()  # acknowledge immediately (required)
     user_id = body["user"]["id"]
     team_id = body["team"]["id"]
     channel = body["channel"]["id"]
     ts = body["message"]["ts"]
 
     try:
-        result = compute_nonengagers(channel, ts)
+        result = await compute_nonengagers(channel, ts)
         names = result["non_names"]
         pop = len(result["population_ids"])
         engaged = len(result["engaged_ids"])
         non_ct = len(result["non_ids"])
 
-        # DM the requester a summary
-        dm = client.conversations_open(users=[user_id])["channel"]["id"]
-        client.chat_postMessage(
-            channel=dm,
-            text=(
+        # DM the requester a summary, plus the full CSV if there's anyone on it
+        dm = await dm_for(user_id)
+        failed = await deliver(
+            dm,
+            (
                 f"*Non-engagers for <https://app.slack.com/client/{team_id}/{channel}/thread/{channel}-{ts.replace('.', '')}|this message>*\n"
                 f"*Members considered:* {pop}  ·  *Engaged:* {engaged}  ·  *Non-engagers:* {non_ct}\n\n"
                 f"{summarize(names)}" if names else "🎉 Everyone engaged (reacted or replied)!"
-            )
+            ),
+            result,
+            logger,
         )
-
-        # Upload full CSV privately via DM
-        if names:
-            csv_bytes = make_csv(result["non_ids"], user_dir_map())
-            client.files_upload_v2(
-                channel=dm,  # DM channel we opened above
-                filename="non_engagers.csv",
-                title="Non-engagers",
-                file=csv_bytes,
+        if failed:
+            await client.chat_postEphemeral(
+                channel=channel,
+                user=user_id,
+                text=delivery_failure_text(failed)
             )
 
-
     except Exception as e:
         logger.exception(e)
-        client.chat_postEphemeral(
+        await client.chat_postEphemeral(
             channel=channel,
             user=user_id,
             text=f"Sorry, I couldn’t compute that: `{e}`"
@@ -209,22 +367,28 @@ def on_shortcut(ack, body, logger):
 # ---------- Slash Command: /nonengagers <permalink> ----------
 # Add a Slash Command in your Slack app settings with command `/nonengagers`
 @app.command("/nonengagers")
-def handle_cmd(ack, body, respond, logger):
-    ack()
+async def handle_cmd(ack, body, respond, logger):
+    await ack()
     text = (body.get("text") or "").strip()
-    m = MSG_URL_RE.search(text)
+    # The link must come last. Slack may wrap it as <url> or <url|label>
+    # (labels can contain spaces) when escaping links.
+    if text.endswith(">") and "<" in text:
+        link = text[text.rfind("<") + 1:-1]
+    else:
+        link = text.split()[-1] if text else ""
+    m = MSG_URL_RE.fullmatch(link.split("|", 1)[0])
     if not m:
-        respond(
-            "Usage: `/nonengagers <message link>`\n"
+        await respond(
+            "Usage: `/nonengagers <message link>` (the link must be the last thing you type)\n"
             "Tip: Long-press a message → *Copy link* and paste here."
         )
         return
 
     channel = m.group("channel")
-    ts = ts_from_permalink_pts(m.group("pts"))
+    ts = f"{m.group('sec')}.{m.group('us')}"
 
     try:
-        result = compute_nonengagers(channel, ts)
+        result = await compute_nonengagers(channel, ts)
         pop = len(result["population_ids"])
         engaged = len(result["engaged_ids"])
         non_ct = len(result["non_ids"])
@@ -232,31 +396,56 @@ def handle_cmd(ack, body, respond, logger):
 
         summary = f"*Members considered:* {pop}  ·  *Engaged:* {engaged}  ·  *Non-engagers:* {non_ct}"
 
-        dm = client.conversations_open(users=[body["user_id"]])["channel"]["id"]
+        dm = await dm_for(body["user_id"])
         
         if names:
             preview = summarize(names)
-            # Nudge in-channel ephemerally, but send details privately
-            respond("I’ve DMed you the results (CSV + summary).")
-            client.chat_postMessage(
-                channel=dm,
-                text=f"{summary}\n\n{preview}"
-            )
-            csv_bytes = make_csv(result["non_ids"], user_dir_map())
-            client.files_upload_v2(
-                channel=dm,
-                filename="non_engagers.csv",
-                title="Non-engagers",
-                file=csv_bytes,
-            )
+            # Send details privately, then nudge in-channel ephemerally
+            failed = await deliver(dm, f"{summary}\n\n{preview}", result, logger)
+            if failed:
+                await respond(delivery_failure_text(failed))
+            else:
+                await respond("I’ve DMed you the results (CSV + summary).")
         else:
-            respond(f"{summary}\n\n🎉 Everyone engaged (reacted or replied)!")
+            await respond(f"{summary}\n\n🎉 Everyone engaged (reacted or replied)!")
 
     except Exception as e:
         logger.exception(e)
-        respond(f"Sorry, I couldn’t compute that: `{e}`")
+        await respond(f"Sorry, I couldn’t compute that: `{e}`")
+
+# ---------- Events: keep the cached user directory fresh ----------
+# Optional: subscribe the app to `user_change` and `team_join` bot events
+@app.event("user_change")
+@app.event("team_join")
+async def on_directory_change(event):
+    # Profile/status edits are frequent in big workspaces; patch the one
+    # user rather than dropping the whole directory.
+    u = event["user"]
+
+    def apply(directory):
+        users, valid_ids = directory
+        users[u["id"]] = u
+        if keep_user(u):
+            valid_ids.add(u["id"])
+        else:
+            valid_ids.discard(u["id"])
+
+    user_dir_map.update(apply)
+
+# ---------- Events: keep cached channel membership fresh ----------
+# Optional: subscribe to `member_joined_channel` and `member_left_channel`
+@app.event("member_joined_channel")
+async def on_member_joined(event):
+    update_cached_members(event["channel"], add=event["user"])
+
+@app.event("member_left_channel")
+async def on_member_left(event):
+    update_cached_members(event["channel"], remove=event["user"])
 
 # ---------- Entrypoint ----------
-if __name__ == "__main__":
+async def main():
     # Socket Mode = no public URL needed
-    SocketModeHandler(app, APP_TOKEN).start()
+    await AsyncSocketModeHandler(app, APP_TOKEN).start_async()
+
+if __name__ == "__main__":
+    asyncio.run(main())